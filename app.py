@@ -1,12 +1,18 @@
 
-import os, io, uuid, traceback, csv, time
+import os, io, uuid, traceback, csv, hmac, hashlib, secrets, sqlite3
 from datetime import datetime, date
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from PIL import Image, ImageOps
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text, bindparam
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.pool import NullPool
 
 # Supabase (para fotos via Storage)
@@ -15,12 +21,7 @@ try:
 except Exception:
     create_client = None
 
-# PDF
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-
-BUILD_TAG = "v08-v6.3-counter-no-returning"
+BUILD_TAG = "v08-v6.4-counter-returning"
 
 st.set_page_config(page_title=f"RNC — {BUILD_TAG}", page_icon="📝", layout="wide")
 
@@ -31,27 +32,87 @@ SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL", "")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET", "RNC-FOTOS")
 QUALITY_PASS    = os.getenv("QUALITY_PASS", "qualidade123")
 INIT_DB_FLAG    = os.getenv("INIT_DB", "true").lower() == "true"
+DB_POOL_SIZE    = int(os.getenv("DB_POOL_SIZE", "3"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "2"))
+QUALITY_HASH    = hashlib.sha256(QUALITY_PASS.encode()).digest()
 
 # ----------------- Conexões -----------------
+def sqlite_pragmas(dbapi_conn, _record):
+    # O pysqlite não emite BEGIN antes de um SAVEPOINT: o RELEASE virava COMMIT e cada
+    # begin_nested() gravava sozinho. Sem o controle do driver, o BEGIN vem de sqlite_begin
+    dbapi_conn.isolation_level = None
+    cur = dbapi_conn.cursor()
+    for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY", "mmap_size=268435456", "foreign_keys=ON"):
+        cur.execute(f"PRAGMA {pragma};")
+    cur.close()
+
+def sqlite_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+@st.cache_resource(show_spinner=False)
+def pg_engine():
+    # Um engine por processo: o pool reaproveita conexões entre reruns e sessões.
+    # Só o sucesso fica em cache: se a conexão falhar, a exceção não é cacheada
+    url = make_url(SUPABASE_DB_URL)
+    if url.port == 6543:
+        # Pooler de transação (PgBouncer): ele já faz o pool e não suporta
+        # prepared statements do lado do servidor
+        kw = {"poolclass": NullPool}
+        if url.get_driver_name() == "psycopg":
+            kw["connect_args"] = {"prepare_threshold": None}
+    else:
+        # LIFO: rajadas reusam as conexões mais quentes e as ociosas expiram sozinhas.
+        # Se o app migrar para asyncio, o equivalente é create_async_engine (AsyncAdaptedQueuePool);
+        # não passar QueuePool explicitamente para um engine assíncrono.
+        kw = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": 30,
+              "pool_pre_ping": True, "pool_recycle": 1800, "pool_use_lifo": True}
+    if url.get_driver_name() == "psycopg2":
+        # Os statements do app são text(): o executemany (ex.: fotos) vai por execute_batch,
+        # que junta vários comandos por ida ao servidor (padrão: 100 por página).
+        # A importação de CSV não passa por aqui: usa COPY
+        kw["executemany_mode"] = "values_plus_batch"
+        kw["executemany_batch_page_size"] = 1000
+    eng = create_engine(url, future=True, **kw)
+    with eng.connect() as c:
+        c.exec_driver_sql("SELECT 1;")
+    return eng
+
+@st.cache_resource(show_spinner=False)
+def sqlite_engine():
+    # SQLite local: pool padrão (reusa conexões) + WAL, bem mais rápido que rollback-journal a cada commit
+    if sqlite3.sqlite_version_info < (3, 35):
+        # Contador, INSERT e DELETE usam RETURNING (SQLite >= 3.35; Debian bullseye traz 3.34)
+        st.error(f"SQLite {sqlite3.sqlite_version} é antigo demais: o app precisa de 3.35 ou mais novo.")
+        st.stop()
+    eng = create_engine("sqlite:///rnc.db", future=True)
+    event.listen(eng, "connect", sqlite_pragmas)
+    event.listen(eng, "begin", sqlite_begin)
+    with eng.connect() as c:
+        c.exec_driver_sql("SELECT 1;")
+    return eng
+
 def get_engine():
+    # A escolha é refeita a cada execução do script: uma queda rápida do Supabase no start
+    # não prende o processo no rnc.db local enquanto as outras instâncias gravam no Supabase
     if SUPABASE_DB_URL:
         try:
-            eng = create_engine(SUPABASE_DB_URL, poolclass=NullPool, future=True)
-            with eng.connect() as c:
-                c.exec_driver_sql("SELECT 1;")
+            eng = pg_engine()
             st.info("🔌 Banco conectado (Supabase).")
             return eng
         except Exception as e:
             st.warning("Não conectou ao Supabase. Usando SQLite local (rnc.db).")
             with st.expander("Detalhes de conexão"):
                 st.code(f"{type(e).__name__}: {e}\n\n{traceback.format_exc()}")
-    eng = create_engine("sqlite:///rnc.db", poolclass=NullPool, future=True)
-    with eng.connect() as c:
-        c.exec_driver_sql("SELECT 1;")
     st.warning("⚠️ Banco local (SQLite) em uso.")
-    return eng
+    return sqlite_engine()
 
+@st.cache_resource(show_spinner=False)
+def active_db() -> dict:
+    return {}
+
+@st.cache_resource(show_spinner=False)
 def get_supabase():
+    # Um cliente (e seu pool HTTPS) por processo, compartilhado entre reruns e sessões
     if not (SUPABASE_URL and SUPABASE_KEY and create_client):
         return None
     try:
@@ -59,9 +120,25 @@ def get_supabase():
     except Exception:
         return None
 
+@st.cache_resource(show_spinner=False)
+def ensure_bucket():
+    # create_bucket uma vez por processo (antes era uma chamada HTTPS a cada envio de fotos)
+    try:
+        supabase.storage.create_bucket(SUPABASE_BUCKET, public=True)
+    except Exception:
+        pass
+    return True
+
 engine = get_engine()
-DB_KIND = engine.url.get_backend_name()
+DB_KIND = engine.dialect.name
+# Trocou de banco (SQLite -> Supabase de volta): os caches de consulta são do banco anterior
+db = active_db()
+if db.get("kind") not in (None, DB_KIND):
+    st.cache_data.clear()
+db["kind"] = DB_KIND
 supabase = get_supabase()
+if supabase:
+    ensure_bucket()
 
 # ----------------- Migrações -----------------
 def try_sql(conn, sql: str):
@@ -71,196 +148,198 @@ def try_sql(conn, sql: str):
     except Exception as e:
         return f"{type(e).__name__}: {e}"
 
-def init_db():
+# DDL montado uma vez no import: os tipos de cada backend são resolvidos aqui
+IS_PG = DB_KIND == "postgresql"
+PK = "BIGSERIAL PRIMARY KEY" if IS_PG else "INTEGER PRIMARY KEY AUTOINCREMENT"
+BIGINT = "BIGINT" if IS_PG else "INTEGER"
+BYTES = "BYTEA" if IS_PG else "BLOB"
+# No Postgres a FK entra pelo ALTER abaixo, que também alcança tabelas já existentes
+FK_INSPECAO = "" if IS_PG else " REFERENCES inspecoes(id) ON DELETE CASCADE"
+
+DDL = (
+    f"""
+    CREATE TABLE IF NOT EXISTS inspecoes (
+        id {PK},
+        data TIMESTAMP NULL,
+        rnc_num TEXT UNIQUE,
+        emitente TEXT,
+        area TEXT,
+        pep TEXT,
+        titulo TEXT,
+        responsavel TEXT,
+        descricao TEXT,
+        referencias TEXT,
+        causador TEXT,
+        processo_envolvido TEXT,
+        origem TEXT,
+        severidade TEXT,
+        categoria TEXT,
+        acoes TEXT,
+        status TEXT DEFAULT 'Aberta',
+        encerrada_em TIMESTAMP NULL,
+        encerrada_por TEXT,
+        encerramento_obs TEXT,
+        encerramento_desc TEXT,
+        eficacia TEXT,
+        responsavel_acao TEXT,
+        reaberta_em TIMESTAMP NULL,
+        reaberta_por TEXT,
+        reabertura_motivo TEXT,
+        reabertura_desc TEXT,
+        cancelada_em TIMESTAMP NULL,
+        cancelada_por TEXT,
+        cancelamento_motivo TEXT
+    );
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS fotos (
+        id {PK},
+        inspecao_id {BIGINT} NOT NULL{FK_INSPECAO},
+        tipo TEXT,
+        url TEXT,
+        path TEXT,
+        filename TEXT,
+        mimetype TEXT
+    );
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS peps (
+        id {PK},
+        code TEXT UNIQUE
+    );
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        blob {BYTES},
+        text TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rnc_counters (
+        year INTEGER PRIMARY KEY,
+        last_seq INTEGER NOT NULL
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uidx_inspecoes_rnc ON inspecoes (rnc_num);",
+    "CREATE INDEX IF NOT EXISTS idx_inspecoes_data ON inspecoes (data DESC);",
+    # (status, id DESC): filtro por status já na ordem da paginação por id, sem ordenar depois.
+    # Substitui o índice só de status
+    "CREATE INDEX IF NOT EXISTS idx_inspecoes_status_id ON inspecoes (status, id DESC);",
+    "DROP INDEX IF EXISTS idx_inspecoes_status;",
+    "CREATE INDEX IF NOT EXISTS idx_inspecoes_pep ON inspecoes (pep);",
+    # (inspecao_id, tipo, id): casa com o WHERE + ORDER BY de fetch_photos e ainda serve ao
+    # cascade da FK (inspecao_id na frente). Substitui o índice só de inspecao_id
+    "CREATE INDEX IF NOT EXISTS idx_fotos_inspecao_tipo ON fotos (inspecao_id, tipo, id);",
+    "DROP INDEX IF EXISTS idx_fotos_inspecao;",
+)
+if IS_PG:
+    DDL += (
+        # FK com cascade também em bancos já existentes; NOT VALID não falha por fotos órfãs antigas
+        """
+        DO $$ BEGIN
+            ALTER TABLE fotos ADD CONSTRAINT fotos_inspecao_fk FOREIGN KEY (inspecao_id)
+                REFERENCES inspecoes(id) ON DELETE CASCADE NOT VALID;
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$;
+        """,
+    )
+DDL_HASH = hashlib.sha256("\n".join(DDL).encode()).hexdigest()
+# Rodam mesmo com o schema em dia (são no-op se já existem): um índice que sumiu
+# (ex.: restauração interrompida) volta no próximo start do processo
+INDEX_DDL = tuple(s for s in DDL if s.startswith(("CREATE INDEX IF NOT EXISTS", "CREATE UNIQUE INDEX IF NOT EXISTS")))
+
+def stored_schema_hash(conn) -> Optional[str]:
+    # SAVEPOINT: no primeiro deploy a tabela settings ainda não existe
+    try:
+        with conn.begin_nested():
+            return conn.execute(text("SELECT text FROM settings WHERE key='schema_hash'")).scalar()
+    except Exception:
+        return None
+
+@st.cache_resource(show_spinner=False)
+def init_db(kind: str):
+    # DDL uma vez por processo e banco (kind entra na chave do cache), não a cada rerun;
+    # e só quando o schema mudou desde o último deploy
     with engine.begin() as conn:
-        if DB_KIND == "postgresql":
+        if IS_PG:
             # forçar schema padrão
             err = try_sql(conn, "SET search_path TO public;")
             if err:
                 try_sql(conn, "CREATE SCHEMA IF NOT EXISTS app;")
                 try_sql(conn, "SET search_path TO app, public;")
-            stmts = [
-                """
-                CREATE TABLE IF NOT EXISTS inspecoes (
-                    id BIGSERIAL PRIMARY KEY,
-                    data TIMESTAMP NULL,
-                    rnc_num TEXT UNIQUE,
-                    emitente TEXT,
-                    area TEXT,
-                    pep TEXT,
-                    titulo TEXT,
-                    responsavel TEXT,
-                    descricao TEXT,
-                    referencias TEXT,
-                    causador TEXT,
-                    processo_envolvido TEXT,
-                    origem TEXT,
-                    severidade TEXT,
-                    categoria TEXT,
-                    acoes TEXT,
-                    status TEXT DEFAULT 'Aberta',
-                    encerrada_em TIMESTAMP NULL,
-                    encerrada_por TEXT,
-                    encerramento_obs TEXT,
-                    encerramento_desc TEXT,
-                    eficacia TEXT,
-                    responsavel_acao TEXT,
-                    reaberta_em TIMESTAMP NULL,
-                    reaberta_por TEXT,
-                    reabertura_motivo TEXT,
-                    reabertura_desc TEXT,
-                    cancelada_em TIMESTAMP NULL,
-                    cancelada_por TEXT,
-                    cancelamento_motivo TEXT
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS fotos (
-                    id BIGSERIAL PRIMARY KEY,
-                    inspecao_id BIGINT NOT NULL,
-                    tipo TEXT,
-                    url TEXT,
-                    path TEXT,
-                    filename TEXT,
-                    mimetype TEXT
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS peps (
-                    id BIGSERIAL PRIMARY KEY,
-                    code TEXT UNIQUE
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    blob BYTEA,
-                    text TEXT
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS rnc_counters (
-                    year INTEGER PRIMARY KEY,
-                    last_seq INTEGER NOT NULL
-                );
-                """,
-                "CREATE UNIQUE INDEX IF NOT EXISTS uidx_inspecoes_rnc ON inspecoes (rnc_num);",
-            ]
-            diag = []
-            for s in stmts:
-                er = try_sql(conn, s)
-                if er: diag.append(er)
-            if diag:
+        if stored_schema_hash(conn) == DDL_HASH:
+            for s in INDEX_DDL:
+                try_sql(conn, s)
+            return True
+        diag = []
+        for s in DDL:
+            er = try_sql(conn, s)
+            if er: diag.append(er)
+        if diag:
+            if IS_PG:
                 with st.expander("📋 Diagnóstico de migração (Postgres)"):
                     st.code("\n".join(diag))
-        else:
-            stmts = [
-                """
-                CREATE TABLE IF NOT EXISTS inspecoes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    data TIMESTAMP NULL,
-                    rnc_num TEXT UNIQUE,
-                    emitente TEXT,
-                    area TEXT,
-                    pep TEXT,
-                    titulo TEXT,
-                    responsavel TEXT,
-                    descricao TEXT,
-                    referencias TEXT,
-                    causador TEXT,
-                    processo_envolvido TEXT,
-                    origem TEXT,
-                    severidade TEXT,
-                    categoria TEXT,
-                    acoes TEXT,
-                    status TEXT DEFAULT 'Aberta',
-                    encerrada_em TIMESTAMP NULL,
-                    encerrada_por TEXT,
-                    encerramento_obs TEXT,
-                    encerramento_desc TEXT,
-                    eficacia TEXT,
-                    responsavel_acao TEXT,
-                    reaberta_em TIMESTAMP NULL,
-                    reaberta_por TEXT,
-                    reabertura_motivo TEXT,
-                    reabertura_desc TEXT,
-                    cancelada_em TIMESTAMP NULL,
-                    cancelada_por TEXT,
-                    cancelamento_motivo TEXT
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS fotos (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    inspecao_id INTEGER NOT NULL,
-                    tipo TEXT,
-                    url TEXT,
-                    path TEXT,
-                    filename TEXT,
-                    mimetype TEXT
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS peps (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    blob BLOB,
-                    text TEXT
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS rnc_counters (
-                    year INTEGER PRIMARY KEY,
-                    last_seq INTEGER NOT NULL
-                );
-                """,
-                "CREATE UNIQUE INDEX IF NOT EXISTS uidx_inspecoes_rnc ON inspecoes (rnc_num);",
-            ]
-            for s in stmts:
-                try_sql(conn, s)
+            return True
+        conn.execute(text(
+            "INSERT INTO settings(key, text) VALUES('schema_hash', :h) "
+            "ON CONFLICT (key) DO UPDATE SET text=EXCLUDED.text"
+        ), {"h": DDL_HASH})
+    return True
 
 if INIT_DB_FLAG:
-    init_db()
+    init_db(DB_KIND)
 
 # ----------------- Helpers -----------------
 def is_quality() -> bool:
     return st.session_state.get("is_quality", False)
 
+def check_quality_pass(pwd: str) -> bool:
+    # Compara hashes em tempo constante (sem canal lateral de tempo)
+    return hmac.compare_digest(hashlib.sha256(pwd.encode()).digest(), QUALITY_HASH)
+
 def auth_box():
-    with st.sidebar.expander("🔐 Acesso Qualidade"):
-        pwd = st.text_input("Senha", type="password", key="pwd_q")
-        c1, c2 = st.columns(2)
-        if c1.button("Entrar"):
-            if pwd == QUALITY_PASS:
-                st.session_state.is_quality = True
-                st.success("Perfil Qualidade ativo.")
-            else:
-                st.error("Senha incorreta.")
-        if c2.button("Sair"):
+    if st.session_state.get("auth_token"):
+        # Sessão já autenticada: não remonta o formulário de senha a cada rerun
+        c1, c2 = st.sidebar.columns([3, 1])
+        c1.caption("🔐 Perfil Qualidade ativo")
+        if c2.button("Sair", key="sair_q"):
             st.session_state.is_quality = False
-            st.info("Saiu do perfil Qualidade.")
+            st.session_state.pop("auth_token", None)
+            st.rerun()
+    else:
+        with st.sidebar.expander("🔐 Acesso Qualidade"):
+            pwd = st.text_input("Senha", type="password", key="pwd_q")
+            if st.button("Entrar"):
+                if check_quality_pass(pwd):
+                    st.session_state.is_quality = True
+                    st.session_state.auth_token = secrets.token_urlsafe(16)
+                    st.rerun()
+                else:
+                    st.error("Senha incorreta.")
 
     with st.sidebar.expander("🖼️ Logo da empresa (PDF)"):
         up = st.file_uploader("Enviar logo (PNG/JPG)", type=["png","jpg","jpeg"], key="uplogo")
-        if up is not None:
-            set_logo(up.getbuffer().tobytes())
+        # Grava só quando chega um arquivo novo, não a cada rerun com o mesmo upload no widget
+        if up is not None and st.session_state.get("logo_file_id") != up.file_id:
+            set_logo(up.getvalue())
+            st.session_state.logo_file_id = up.file_id
             st.success("Logo atualizada.")
         if st.button("Remover logo"):
             clear_logo(); st.warning("Logo removida.")
 
+SET_LOGO_STMT = text(
+    "INSERT INTO settings(key, blob) VALUES('logo', :b) ON CONFLICT (key) DO UPDATE SET blob=EXCLUDED.blob"
+)
+
 def set_logo(image_bytes: bytes):
     with engine.begin() as conn:
-        if DB_KIND == "postgresql":
-            conn.exec_driver_sql("INSERT INTO settings(key, blob) VALUES('logo', :b) ON CONFLICT (key) DO UPDATE SET blob=EXCLUDED.blob", {"b": image_bytes})
-        else:
-            conn.exec_driver_sql("INSERT OR REPLACE INTO settings(key, blob) VALUES('logo', :b)", {"b": image_bytes})
+        conn.execute(SET_LOGO_STMT, {"b": image_bytes})
+    get_logo.clear()
 
+@st.cache_resource(show_spinner=False)
 def get_logo() -> Optional[bytes]:
+    # Muda raramente: lido do banco uma vez e invalidado por set_logo/clear_logo
     with engine.begin() as conn:
         r = conn.exec_driver_sql("SELECT blob FROM settings WHERE key='logo'").fetchone()
     return bytes(r[0]) if (r and r[0] is not None) else None
@@ -268,15 +347,60 @@ def get_logo() -> Optional[bytes]:
 def clear_logo():
     with engine.begin() as conn:
         conn.exec_driver_sql("DELETE FROM settings WHERE key='logo'")
+    get_logo.clear()
+
+INSERT_PEP_STMT = text("INSERT INTO peps (code) VALUES (:c) ON CONFLICT (code) DO NOTHING")
+# Postgres: a lista inteira vai como um array num único statement; rowcount = novos
+INSERT_PEPS_PG_STMT = text(
+    "INSERT INTO peps (code) SELECT unnest(CAST(:codes AS TEXT[])) ON CONFLICT (code) DO NOTHING"
+)
+
+def add_peps_bulk(codes) -> int:
+    # Um único statement/executemany; retorna quantos PEPs eram de fato novos
+    codes = list(dict.fromkeys(str(c).strip() for c in codes if str(c).strip()))
+    if not codes:
+        return 0
+    with engine.begin() as conn:
+        if IS_PG:
+            n = conn.execute(INSERT_PEPS_PG_STMT, {"codes": codes}).rowcount
+        else:
+            before = conn.exec_driver_sql("SELECT COUNT(*) FROM peps").scalar_one()
+            conn.execute(INSERT_PEP_STMT, [{"c": c} for c in codes])
+            after = conn.exec_driver_sql("SELECT COUNT(*) FROM peps").scalar_one()
+            n = int(after) - int(before)
+    if n:
+        load_peps.clear()
+    return n
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_peps() -> pd.DataFrame:
+    # Lista de PEPs em cache (tela de PEPs e selectbox da Nova RNC); add_peps_bulk invalida
+    # quando entra algo novo, o TTL só cobre alterações feitas fora do app
+    return pd.read_sql(text("SELECT id, code FROM peps ORDER BY code"), engine, dtype_backend="pyarrow")
 
 def get_supabase_bucket():
     if not supabase:
         return None
+    return supabase.storage.from_(SUPABASE_BUCKET)
+
+MAX_IMG_SIDE = 1600
+
+def shrink_image(data: bytes) -> Optional[bytes]:
+    # Foto de celular (4000x3000, vários MB) reduzida para 1600px em JPEG antes do envio.
+    # None = manter o original (não é imagem, já cabe em MAX_IMG_SIDE, ou não ficou menor):
+    # foto que não precisa de redução não passa por uma segunda compressão com perda
     try:
-        supabase.storage.create_bucket(SUPABASE_BUCKET, public=True)
+        img = Image.open(io.BytesIO(data))  # só lê o cabeçalho
+        if max(img.size) <= MAX_IMG_SIDE:
+            return None
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MAX_IMG_SIDE, MAX_IMG_SIDE), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=82, optimize=True, progressive=True)
     except Exception:
-        pass
-    return supabase.storage.from_(SUPABASE_BUCKET)
+        return None
+    small = buf.getvalue()
+    return small if len(small) < len(data) else None
 
 def upload_photos(files, rnc_num: str, tipo: str):
     out = []
@@ -286,122 +410,357 @@ def upload_photos(files, rnc_num: str, tipo: str):
     if not bucket:
         st.warning("Supabase Storage não configurado — as fotos não serão enviadas para a nuvem.")
         return out
-    for f in files:
+    # Leitura na thread principal (UploadedFile e st.* não são thread-safe);
+    # redução da imagem e PUT HTTPS vão para o pool de threads
+    jobs = [(f.name, f.type or "image/jpeg", f.getvalue()) for f in files]
+
+    def send(job):
+        name, mime, data = job
+        ext = os.path.splitext(name)[1].lower() or ".jpg"
+        small = shrink_image(data)
+        if small is not None:
+            data, mime, ext = small, "image/jpeg", ".jpg"
+        key = f"{rnc_num}/{tipo}/{uuid.uuid4().hex}{ext}"
+        bucket.upload(key, data, {"content-type": mime})
+        return {"url": bucket.get_public_url(key), "path": key, "filename": name, "mimetype": mime, "tipo": tipo}
+
+    with ThreadPoolExecutor(max_workers=min(8, len(jobs))) as ex:
+        futs = [ex.submit(send, j) for j in jobs]
+    for (name, _, _), fut in zip(jobs, futs):
         try:
-            ext = os.path.splitext(f.name)[1].lower() or ".jpg"
-            key = f"{rnc_num}/{tipo}/{uuid.uuid4().hex}{ext}"
-            data = f.read(); f.seek(0)
-            bucket.upload(key, data, {"content-type": f.type or "image/jpeg"})
-            url = bucket.get_public_url(key)
-            out.append({"url": url, "path": key, "filename": f.name, "mimetype": f.type or "image/jpeg", "tipo": tipo})
+            out.append(fut.result())
         except Exception as e:
-            st.error(f"Falha ao subir {f.name}: {e}")
+            st.error(f"Falha ao subir {name}: {e}")
     return out
 
-# ---------- Contador por ano (sem RETURNING) ----------
-def next_rnc_num_tx(conn) -> str:
-    y = int(datetime.now().year)
-    if DB_KIND == "postgresql":
-        # 1) UPSERT sem RETURNING
-        conn.exec_driver_sql("""
-            INSERT INTO rnc_counters (year, last_seq)
-            VALUES (:y, 1)
-            ON CONFLICT (year)
-            DO UPDATE SET last_seq = rnc_counters.last_seq + 1;
-        """, {"y": y})
-        # 2) Lê o valor final
-        seq = conn.exec_driver_sql("SELECT last_seq FROM rnc_counters WHERE year=:y", {"y": y}).scalar_one()
+def remove_photos(paths):
+    # Best-effort: sem isso os arquivos das RNCs excluídas ficavam órfãos no bucket
+    bucket = get_supabase_bucket()
+    if not (bucket and paths):
+        return
+    try:
+        bucket.remove(list(paths))
+    except Exception as e:
+        st.warning(f"Fotos não removidas do Storage: {e}")
+
+def sniff_sep(up) -> str:
+    # Separador pela primeira linha: ";" (Excel pt-BR) ou ","
+    up.seek(0)
+    head = up.readline().decode("utf-8-sig", "ignore")
+    up.seek(0)
+    return ";" if head.count(";") > head.count(",") else ","
+
+def read_csv_fast(up, text_cols=(), sep=None) -> pd.DataFrame:
+    # pyarrow.csv (C++, multithread) com as colunas de texto tipadas já no parse;
+    # no engine="pyarrow" do pandas o dtype é aplicado depois e "001" viraria "1.0".
+    # Se o pyarrow recusar o arquivo, parser C do pandas.
+    sep = sep or sniff_sep(up)
+    up.seek(0)
+    try:
+        tbl = pacsv.read_csv(
+            up, parse_options=pacsv.ParseOptions(delimiter=sep),
+            convert_options=pacsv.ConvertOptions(column_types={c: pa.string() for c in text_cols},
+                                                 strings_can_be_null=True),
+        )
+        return tbl.to_pandas()
+    except Exception:
+        up.seek(0)
+        return pd.read_csv(up, sep=sep, dtype={c: "string" for c in text_cols}, low_memory=False)
+
+def parse_dates(s: pd.Series) -> pd.Series:
+    # Caminho rápido: ISO 8601 (o export do próprio app) no parser C vetorizado.
+    # Se algum valor fugir do padrão (ex.: 02/01/2026), cai no "mixed", valor a valor
+    try:
+        return pd.to_datetime(s, format="ISO8601")
+    except (ValueError, TypeError):
+        return pd.to_datetime(s, errors="coerce", format="mixed")
+
+CSV_CHUNK_ROWS = 5000
+CSV_CHUNK_BYTES = 8 * 1024 * 1024
+
+def norm_headers(cols) -> pd.Index:
+    # Cabeçalhos normalizados numa passada só (" Data ", "Título", "Processo Envolvido" também casam)
+    return (pd.Index(cols).astype(str).str.strip().str.lower().str.replace(" ", "_", regex=False)
+            .str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii"))
+
+def raw_text_cols(up, sep, text_cols) -> list:
+    # O tipo texto vale já no parse, então vai pelo nome cru do cabeçalho ("PEP", "RNC Num"):
+    # sem isso "0005" seria inferido como número antes da normalização
+    up.seek(0)
+    head = next(csv.reader([up.readline().decode("utf-8-sig", "ignore")], delimiter=sep), [])
+    up.seek(0)
+    want = set(text_cols)
+    return [raw for raw, n in zip(head, norm_headers(head)) if n in want]
+
+def iter_csv_chunks(up, text_cols=()):
+    # Arquivo pequeno: uma leitura só pelo pyarrow. Restauração grande: blocos de
+    # CSV_CHUNK_ROWS linhas pelo parser C, e a memória não cresce com o tamanho do arquivo.
+    # text_cols e as colunas devolvidas usam os nomes já normalizados
+    sep = sniff_sep(up)
+    raw_text = raw_text_cols(up, sep, text_cols)
+    if up.getbuffer().nbytes <= CSV_CHUNK_BYTES:
+        chunks = [read_csv_fast(up, raw_text, sep)]
     else:
-        try:
-            conn.exec_driver_sql("""
-                INSERT INTO rnc_counters(year, last_seq) VALUES (:y, 1)
-                ON CONFLICT(year) DO UPDATE SET last_seq = last_seq + 1;
-            """, {"y": y})
-            seq = conn.exec_driver_sql("SELECT last_seq FROM rnc_counters WHERE year=:y", {"y": y}).scalar_one()
-        except Exception:
-            row = conn.exec_driver_sql("SELECT last_seq FROM rnc_counters WHERE year=:y", {"y": y}).fetchone()
-            if row is None:
-                conn.exec_driver_sql("INSERT INTO rnc_counters(year, last_seq) VALUES (:y, 1)", {"y": y})
-                seq = 1
-            else:
-                seq = int(row[0]) + 1
-                conn.exec_driver_sql("UPDATE rnc_counters SET last_seq=:s WHERE year=:y", {"s": seq, "y": y})
-    return f"{y}-{int(seq):03d}"
+        chunks = pd.read_csv(up, sep=sep, dtype={c: "string" for c in raw_text}, chunksize=CSV_CHUNK_ROWS)
+    for chunk in chunks:
+        chunk.columns = norm_headers(chunk.columns)
+        yield chunk
+
+# ---------- Contador por ano ----------
+# Statements compilados uma vez por processo (cache de compilação do SQLAlchemy)
+COUNTER_STMT = text("""
+    INSERT INTO rnc_counters (year, last_seq) VALUES (:y, :n)
+    ON CONFLICT (year) DO UPDATE SET last_seq = rnc_counters.last_seq + :n
+    RETURNING last_seq;
+""")
+EXISTING_RNC_STMT = text("SELECT rnc_num FROM inspecoes WHERE rnc_num IN :nums").bindparams(bindparam("nums", expanding=True))
+
+def reserve_rnc_nums_tx(conn, n: int, y: int) -> list:
+    # Reserva n números consecutivos do ano com um único UPSERT atômico (Postgres e SQLite >= 3.35)
+    last = int(conn.execute(COUNTER_STMT, {"y": y, "n": n}).scalar_one())
+    prefix = f"{y}-"
+    return [f"{prefix}{s:03d}" for s in range(last - n + 1, last + 1)]
+
+def existing_rnc_nums(conn, nums) -> set:
+    nums, out = list(nums), set()
+    for i in range(0, len(nums), 500):
+        out.update(conn.execute(EXISTING_RNC_STMT, {"nums": nums[i:i + 500]}).scalars())
+    return out
+
+def alloc_rnc_nums_tx(conn, n: int, exclude=frozenset()) -> list:
+    # Pula números que já existem (ex.: importados do CSV com número próprio) e os de
+    # exclude (números do CSV que ainda vão entrar na mesma carga)
+    y = datetime.now().year  # um único ano para o lote inteiro
+    out = []
+    while len(out) < n:
+        nums = reserve_rnc_nums_tx(conn, n - len(out), y)
+        taken = existing_rnc_nums(conn, nums) | (set(nums) & exclude)
+        out.extend(x for x in nums if x not in taken)
+    return out
+
+INSERT_INSPECAO_SQL = """
+    INSERT INTO inspecoes
+    (data, rnc_num, emitente, area, pep, titulo, responsavel, descricao, referencias, causador,
+     processo_envolvido, origem, severidade, categoria, acoes, status)
+    VALUES (:data, :rnc, :emit, :area, :pep, :tit, '', :desc, :refs, :cau, :proc, :ori, :sev, :cat, '', 'Aberta')
+"""
+INSERT_INSPECAO_STMT = text(INSERT_INSPECAO_SQL)
+INSERT_INSPECAO_RETURNING_STMT = text(INSERT_INSPECAO_SQL + " RETURNING id")
+# Postgres: contador e INSERT num único statement (CTE com DML). A CTE roda uma vez só,
+# mesmo referenciada na subconsulta; o VALUES mantém a tipagem dos parâmetros pelas colunas
+INSERT_INSPECAO_FUSED_PG_STMT = text("""
+    WITH c AS (
+        INSERT INTO rnc_counters (year, last_seq) VALUES (:y, 1)
+        ON CONFLICT (year) DO UPDATE SET last_seq = rnc_counters.last_seq + 1
+        RETURNING last_seq
+    )
+""" + INSERT_INSPECAO_SQL.replace(
+    ":rnc", "(SELECT :prefix || lpad(last_seq::text, greatest(3, length(last_seq::text)), '0') FROM c)"
+) + " RETURNING id, rnc_num")
+# COPY para a importação em massa: mesmas colunas e constantes do INSERT acima
+COPY_KEYS = ("data", "rnc", "emit", "area", "pep", "tit", "desc", "refs", "cau", "proc", "ori", "sev", "cat")
+COPY_INSPECOES_SQL = (
+    "COPY inspecoes (data, rnc_num, emitente, area, pep, titulo, descricao, referencias, causador, "
+    "processo_envolvido, origem, severidade, categoria, responsavel, acoes, status) FROM STDIN"
+)
+
+def insert_inspecoes_bulk(conn, recs):
+    # Postgres: COPY FROM STDIN, o carregador em lote mais rápido do servidor.
+    # Usa o cursor DBAPI da mesma conexão, então fica na mesma transação. SQLite: executemany
+    if not recs:
+        return
+    driver = conn.dialect.driver
+    if driver not in ("psycopg2", "psycopg"):
+        conn.execute(INSERT_INSPECAO_STMT, recs)
+        return
+    rows = ([r[k] for k in COPY_KEYS] + ["", "", "Aberta"] for r in recs)
+    cur = conn.connection.cursor()
+    try:
+        if driver == "psycopg":
+            with cur.copy(COPY_INSPECOES_SQL) as cp:
+                for row in rows:
+                    cp.write_row(row)
+        else:
+            buf = io.StringIO()
+            csv.writer(buf, lineterminator="\n").writerows(["\\N" if v is None else v for v in row] for row in rows)
+            buf.seek(0)
+            cur.copy_expert(COPY_INSPECOES_SQL + " WITH (FORMAT csv, NULL '\\N')", buf)
+    finally:
+        cur.close()
+
+# Índices secundários de inspecoes (o único de rnc_num fica: a importação consulta por ele)
+SECONDARY_INDEXES_STMT = text(
+    "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() "
+    "AND tablename = 'inspecoes' AND indexdef NOT LIKE :u"
+    if IS_PG else
+    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'inspecoes' "
+    "AND sql IS NOT NULL AND sql NOT LIKE :u"
+)
+# Só restaurações de backup/export (arquivos grandes): no Postgres o DROP INDEX trava inspecoes
+# com ACCESS EXCLUSIVE até o COMMIT da importação, e nesse tempo Consultar, Nova RNC e o
+# export das outras sessões ficam esperando
+RESTORE_BYTES = 32 * 1024 * 1024
+
+def drop_secondary_indexes(conn) -> list:
+    # Carga grande: recriar as B-trees no fim custa menos que atualizá-las linha a linha.
+    # Mesma transação da carga: um ROLLBACK devolve os índices. Devolve o DDL para recriar.
+    # No Postgres a tabela fica bloqueada para as outras sessões até o COMMIT (ver RESTORE_BYTES)
+    defs = conn.execute(SECONDARY_INDEXES_STMT, {"u": "CREATE UNIQUE%"}).all()
+    for name, _ in defs:
+        conn.exec_driver_sql(f'DROP INDEX "{name}"')
+    return [ddl for _, ddl in defs]
+
+def recreate_indexes(conn, defs):
+    if defs and IS_PG:
+        conn.exec_driver_sql("SET LOCAL maintenance_work_mem = '256MB'")
+    for ddl in defs:
+        conn.exec_driver_sql(ddl)
+
+INSERT_FOTO_STMT = text("""
+    INSERT INTO fotos (inspecao_id, tipo, url, path, filename, mimetype)
+    VALUES (:i, :t, :u, :p, :n, :m)
+""")
+
+def insert_photos(conn, iid: int, metas):
+    # Todas as fotos num único executemany (uma ida ao banco, não uma por foto)
+    if metas:
+        conn.execute(INSERT_FOTO_STMT, [
+            {"i": int(iid), "t": m["tipo"], "u": m["url"], "p": m["path"], "n": m["filename"], "m": m["mimetype"]}
+            for m in metas
+        ])
 
 def insert_rnc_with_counter(conn, payload: dict):
-    # Tenta até 20 vezes caso duas pessoas salvem ao mesmo tempo
-    for _ in range(20):
-        num = next_rnc_num_tx(conn)
-        payload2 = dict(payload); payload2["rnc"] = num
+    # O UPSERT do contador serializa quem salva ao mesmo tempo. Só um conflito real de rnc_num
+    # (corrida com uma importação de CSV) justifica repetir: o SAVEPOINT desfaz a tentativa e a
+    # segunda alocação já enxerga o número ocupado.
+    # No Postgres a 1ª tentativa é uma ida só ao banco; se o número já existir, a 2ª usa a
+    # alocação que pula os ocupados.
+    for attempt in (1, 2):
         try:
-            if DB_KIND == "postgresql":
-                rid = conn.exec_driver_sql("""
-                    INSERT INTO inspecoes
-                    (data, rnc_num, emitente, area, pep, titulo, responsavel, descricao, referencias, causador,
-                     processo_envolvido, origem, severidade, categoria, acoes, status)
-                    VALUES (:data, :rnc, :emit, :area, :pep, :tit, '', :desc, :refs, :cau, :proc, :ori, :sev, :cat, '', 'Aberta')
-                    ON CONFLICT (rnc_num) DO NOTHING
-                    RETURNING id;
-                """, payload2).scalar()
-                if rid is not None:
-                    return int(rid), num
-            else:
-                conn.exec_driver_sql("""
-                    INSERT OR IGNORE INTO inspecoes
-                    (data, rnc_num, emitente, area, pep, titulo, responsavel, descricao, referencias, causador,
-                     processo_envolvido, origem, severidade, categoria, acoes, status)
-                    VALUES (:data, :rnc, :emit, :area, :pep, :tit, '', :desc, :refs, :cau, :proc, :ori, :sev, :cat, '', 'Aberta');
-                """, payload2)
-                lrid = conn.exec_driver_sql("SELECT last_insert_rowid()").scalar()
-                if lrid and int(lrid) > 0:
-                    return int(lrid), num
-        except Exception:
-            pass
-        time.sleep(0.02)
-    raise RuntimeError("Não foi possível alocar número de RNC.")
+            with conn.begin_nested():
+                if IS_PG and attempt == 1:
+                    y = datetime.now().year
+                    rid, num = conn.execute(INSERT_INSPECAO_FUSED_PG_STMT, dict(payload, y=y, prefix=f"{y}-")).one()
+                else:
+                    num = alloc_rnc_nums_tx(conn, 1)[0]
+                    rid = conn.execute(INSERT_INSPECAO_RETURNING_STMT, dict(payload, rnc=num)).scalar_one()
+            return int(rid), num
+        except IntegrityError:
+            if attempt == 2:
+                raise
 
-# ----------------- UI (igual às versões anteriores) -----------------
-def is_quality() -> bool:
-    return st.session_state.get("is_quality", False)
+# ---------- Consultas com cache ----------
+LIST_COLS = "id, data, rnc_num, titulo, emitente, area, pep, categoria, severidade, status"
+STATUS_OPTS = ["Aberta", "Em ação", "Encerrada", "Cancelada"]
+SEV_OPTS = ["Baixa", "Média", "Alta", "Crítica"]
 
-def auth_box():
-    with st.sidebar.expander("🔐 Acesso Qualidade"):
-        pwd = st.text_input("Senha", type="password", key="pwd_q")
-        c1, c2 = st.columns(2)
-        if c1.button("Entrar"):
-            if pwd == QUALITY_PASS:
-                st.session_state.is_quality = True
-                st.success("Perfil Qualidade ativo.")
-            else:
-                st.error("Senha incorreta.")
-        if c2.button("Sair"):
-            st.session_state.is_quality = False
-            st.info("Saiu do perfil Qualidade.")
+def inspecoes_where(status=(), sev=(), area="", pep=""):
+    conds, params, expanding = [], {}, []
+    if status:
+        conds.append("status IN :status"); params["status"] = list(status); expanding.append("status")
+    if sev:
+        conds.append("severidade IN :sev"); params["sev"] = list(sev); expanding.append("sev")
+    if area:
+        conds.append("LOWER(area) LIKE :area"); params["area"] = f"%{area.lower()}%"
+    if pep:
+        conds.append("LOWER(pep) LIKE :pep"); params["pep"] = f"%{pep.lower()}%"
+    return conds, params, expanding
 
-    with st.sidebar.expander("🖼️ Logo da empresa (PDF)"):
-        up = st.file_uploader("Enviar logo (PNG/JPG)", type=["png","jpg","jpeg"], key="uplogo")
-        if up is not None:
-            set_logo(up.getbuffer().tobytes())
-            st.success("Logo atualizada.")
-        if st.button("Remover logo"):
-            clear_logo(); st.warning("Logo removida.")
+PAGE_SIZE = 100
 
-def set_logo(image_bytes: bytes):
+# Toda escrita chama invalidate_inspecoes() (o cache é do processo, vale para todas as sessões);
+# o TTL só cobre alterações feitas fora do app.
+@st.cache_data(ttl=60, show_spinner=False)
+def load_inspecoes_page(cursor: Optional[int], filtros: tuple = (), n: int = PAGE_SIZE) -> pd.DataFrame:
+    # Filtros e paginação por chave (id < cursor) no servidor: só a página visível trafega
+    conds, params, expanding = inspecoes_where(*filtros)
+    if cursor is not None:
+        conds.append("id < :c"); params["c"] = cursor
+    where = f"WHERE {' AND '.join(conds)}" if conds else ""
+    stmt = text(f"SELECT {LIST_COLS} FROM inspecoes {where} ORDER BY id DESC LIMIT :n")
+    stmt = stmt.bindparams(*[bindparam(k, expanding=True) for k in expanding])
+    # data chega como datetime (Arrow) direto do driver; a formatação fica só na exibição
+    return pd.read_sql(stmt, engine, params=dict(params, n=n), parse_dates=["data"], dtype_backend="pyarrow")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def count_inspecoes(filtros: tuple = ()) -> int:
+    # Total com os mesmos filtros, para o "Página X de Y"
+    conds, params, expanding = inspecoes_where(*filtros)
+    where = f"WHERE {' AND '.join(conds)}" if conds else ""
+    stmt = text(f"SELECT COUNT(*) FROM inspecoes {where}")
+    stmt = stmt.bindparams(*[bindparam(k, expanding=True) for k in expanding])
     with engine.begin() as conn:
-        if DB_KIND == "postgresql":
-            conn.exec_driver_sql("INSERT INTO settings(key, blob) VALUES('logo', :b) ON CONFLICT (key) DO UPDATE SET blob=EXCLUDED.blob", {"b": image_bytes})
-        else:
-            conn.exec_driver_sql("INSERT OR REPLACE INTO settings(key, blob) VALUES('logo', :b)", {"b": image_bytes})
+        return int(conn.execute(stmt, params).scalar())
 
-def clear_logo():
+def invalidate_inspecoes():
+    load_inspecoes_page.clear()
+    count_inspecoes.clear()
+    export_csv_bytes.clear()
+    fetch_photos.clear()
+
+DELETE_FOTOS_STMT = text("DELETE FROM fotos WHERE inspecao_id=:i RETURNING path")
+DELETE_INSPECAO_STMT = text("DELETE FROM inspecoes WHERE id=:i")
+
+def delete_inspecao(iid: int) -> list:
+    # O cascade cobre bancos novos; o DELETE explícito cobre tabelas criadas antes da FK
+    # e devolve os paths para limpar o Storage
     with engine.begin() as conn:
-        conn.exec_driver_sql("DELETE FROM settings WHERE key='logo'")
+        paths = [p for p in conn.execute(DELETE_FOTOS_STMT, {"i": int(iid)}).scalars() if p]
+        conn.execute(DELETE_INSPECAO_STMT, {"i": int(iid)})
+    return paths
 
-auth_box()
-menu = st.sidebar.radio("Menu", ["➕ Nova RNC", "🔎 Consultar/Editar", "🏷️ PEPs", "⬇️⬆️ CSV", "ℹ️ Status"])
+ENCERRAR_STMT = text("""
+    UPDATE inspecoes SET status='Encerrada', encerrada_em=:dt, encerrada_por=:por,
+        encerramento_obs=:obs, encerramento_desc=:desc, eficacia=:ef WHERE id=:i
+""")
+REABRIR_STMT = text("""
+    UPDATE inspecoes SET status='Em ação', reaberta_em=:dt, reaberta_por=:por,
+        reabertura_motivo=:mot, reabertura_desc=:desc WHERE id=:i
+""")
+CANCELAR_STMT = text("""
+    UPDATE inspecoes SET status='Cancelada', cancelada_em=:dt, cancelada_por=:por, cancelamento_motivo=:mot WHERE id=:i
+""")
+
+ROW_STMT = text("SELECT * FROM inspecoes WHERE id=:i")
+FOTOS_STMT = text("SELECT * FROM fotos WHERE inspecao_id=:i ORDER BY tipo, id")
+
+def fetch_row(iid: int) -> Optional[dict]:
+    # Só a linha pedida, não a tabela inteira
+    with engine.begin() as conn:
+        r = conn.execute(ROW_STMT, {"i": int(iid)}).mappings().first()
+    return dict(r) if r else None
+
+@st.cache_data(ttl=120, show_spinner=False)
+def fetch_photos(iid: int) -> dict:
+    # Uma ida ao banco para os três tipos; agrupado em Python. Em cache por RNC:
+    # reruns da mesma tela (abrir expander, digitar) não repetem a consulta
+    out = {"abertura": [], "encerramento": [], "reabertura": []}
+    with engine.begin() as conn:
+        for fo in conn.execute(FOTOS_STMT, {"i": int(iid)}).mappings():
+            out.setdefault(fo["tipo"], []).append(dict(fo))
+    return out
+
+@st.cache_data(ttl=60, show_spinner=False)
+def export_csv_bytes() -> bytes:
+    # Cursor no servidor + csv.writer direto em bytes: sem DataFrame nem string intermediária.
+    # Em cache até a próxima gravação: cliques repetidos não refazem a varredura da tabela
+    buf = io.BytesIO()
+    out = io.TextIOWrapper(buf, encoding="utf-8-sig", newline="")
+    w = csv.writer(out, lineterminator="\n")
+    with engine.connect().execution_options(stream_results=True, yield_per=5000) as c:
+        res = c.exec_driver_sql("SELECT * FROM inspecoes ORDER BY id DESC")
+        w.writerow(res.keys())
+        for part in res.partitions():
+            w.writerows(part)
+    out.flush()
+    return buf.getvalue()
+
+# ----------------- UI (igual às versões anteriores) -----------------
+# Cada página é um fragmento: interações dentro dela reexecutam só a página, não o script todo
 
 # ➕ Nova RNC
-if menu == "➕ Nova RNC":
+@st.fragment
+def page_nova():
     st.title(f"Nova RNC — {BUILD_TAG}")
     with st.form("form_rnc"):
         col0, col1, col2 = st.columns(3)
@@ -412,9 +771,9 @@ if menu == "➕ Nova RNC":
         area = st.text_input("Área/Local", placeholder="Ex.: Correia TR-2011KS-07")
         categoria = st.selectbox("Categoria", ["Segurança","Qualidade","Meio Ambiente","Operação","Manutenção","Outros"])
         severidade = st.selectbox("Severidade", ["Baixa","Média","Alta","Crítica"])
-        with engine.begin() as conn:
-            peps = [r[0] for r in conn.exec_driver_sql("SELECT code FROM peps ORDER BY code").fetchall()]
-        pep = st.selectbox("PEP (código — descrição)", options=[""] + peps)
+        peps = load_peps()["code"].tolist()
+        pep = st.selectbox("PEP (código — descrição)", options=[""] + peps,
+                           help="Digite parte do código para filtrar a lista.")
 
         causador = st.selectbox("Causador", ["Solda","Pintura","Engenharia","Fornecedor","Cliente","Caldeiraria","Usinagem","Planejamento","Qualidade","RH","Outros"])
         processo = st.selectbox("Processo envolvido", ["Comercial","Compras","Planejamento","Recebimento","Produção","Inspeção Final","Segurança","Meio Ambiente","5S","RH","Outros"])
@@ -438,137 +797,180 @@ if menu == "➕ Nova RNC":
                 "desc": descricao, "refs": referencias, "cau": causador,
                 "proc": processo, "ori": origem, "sev": severidade, "cat": categoria
             }
-            with engine.begin() as conn:
-                new_id, rnc = insert_rnc_with_counter(conn, payload)
-            metas = upload_photos(fotos_ab or [], rnc, "abertura")
-            with engine.begin() as conn:
-                for m in metas:
-                    conn.exec_driver_sql("""
-                        INSERT INTO fotos (inspecao_id, tipo, url, path, filename, mimetype)
-                        VALUES (:i,:t,:u,:p,:n,:m)
-                    """, {"i": new_id, "t": m["tipo"], "u": m["url"], "p": m["path"], "n": m["filename"], "m": m["mimetype"]})
+            if fotos_ab:
+                # Número reservado antes, num commit curto (o lock do contador não fica preso
+                # durante o upload HTTP); RNC + fotos entram juntas numa transação só
+                with engine.begin() as conn:
+                    rnc = alloc_rnc_nums_tx(conn, 1)[0]
+                metas = upload_photos(fotos_ab, rnc, "abertura")
+                # Atômico também no SQLite: sqlite_begin abre a transação antes do SAVEPOINT, então o
+                # RELEASE não grava a RNC sozinha; se insert_photos falhar, a RNC volta junto
+                with engine.begin() as conn:
+                    try:
+                        with conn.begin_nested():
+                            new_id = int(conn.execute(INSERT_INSPECAO_RETURNING_STMT, dict(payload, rnc=rnc)).scalar_one())
+                    except IntegrityError:
+                        # Número tomado por uma importação de CSV durante o upload: aloca outro
+                        new_id, rnc = insert_rnc_with_counter(conn, payload)
+                    insert_photos(conn, new_id, metas)
+            else:
+                with engine.begin() as conn:
+                    new_id, rnc = insert_rnc_with_counter(conn, payload)
+            invalidate_inspecoes()
             st.success(f"RNC salva! Nº {rnc} (ID {new_id})")
 
 # 🔎 Consultar/Editar
-elif menu == "🔎 Consultar/Editar":
+# Cada ação é um fragmento próprio: digitar nos campos de um expander reexecuta só ele.
+# Depois de gravar, um rerun completo atualiza tabela e status (a mensagem vai pelo session_state)
+def acao_feita(msg: str):
+    invalidate_inspecoes()
+    st.session_state.consulta_msg = msg
+    st.rerun()
+
+@st.fragment
+def acao_encerrar(row: dict):
+    iid = int(row["id"])
+    with st.expander("✅ Encerrar RNC"):
+        encerr_por = st.text_input("Encerrada por", key=f"encpor_{iid}")
+        encerr_obs = st.text_area("Observações", key=f"encobs_{iid}")
+        encerr_desc = st.text_area("Descrição do fechamento", key=f"encdesc_{iid}")
+        eficacia = st.selectbox("Eficácia", ["A verificar","Eficaz","Não eficaz"], key=f"ef_{iid}")
+        fotos_enc = st.file_uploader("Evidências (fotos)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"encf_{iid}")
+        if st.button("Encerrar agora", key=f"encok_{iid}"):
+            metas = upload_photos(fotos_enc or [], row["rnc_num"], "encerramento")
+            with engine.begin() as conn:
+                conn.execute(ENCERRAR_STMT, {"dt": datetime.now(), "por": encerr_por, "obs": encerr_obs,
+                                             "desc": encerr_desc, "ef": eficacia, "i": iid})
+                insert_photos(conn, iid, metas)
+            acao_feita("RNC encerrada.")
+
+@st.fragment
+def acao_reabrir(row: dict):
+    iid = int(row["id"])
+    with st.expander("♻️ Reabrir RNC"):
+        reab_por = st.text_input("Reaberta por", key=f"repor_{iid}")
+        reab_motivo = st.text_input("Motivo", key=f"remot_{iid}")
+        reab_desc = st.text_area("Descrição da reabertura", key=f"redesc_{iid}")
+        fotos_rea = st.file_uploader("Fotos (opcional)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"ref_{iid}")
+        if st.button("Reabrir agora", key=f"reok_{iid}"):
+            metas = upload_photos(fotos_rea or [], row["rnc_num"], "reabertura")
+            with engine.begin() as conn:
+                conn.execute(REABRIR_STMT, {"dt": datetime.now(), "por": reab_por, "mot": reab_motivo,
+                                            "desc": reab_desc, "i": iid})
+                insert_photos(conn, iid, metas)
+            acao_feita("RNC reaberta.")
+
+@st.fragment
+def acao_cancelar(row: dict):
+    iid = int(row["id"])
+    with st.expander("🚫 Cancelar RNC"):
+        c_por = st.text_input("Cancelada por", key=f"canpor_{iid}")
+        c_mot = st.text_area("Motivo", key=f"canmot_{iid}")
+        if st.button("Cancelar", key=f"canok_{iid}"):
+            with engine.begin() as conn:
+                conn.execute(CANCELAR_STMT, {"dt": datetime.now(), "por": c_por, "mot": c_mot, "i": iid})
+            acao_feita("RNC cancelada.")
+
+@st.fragment
+def acao_excluir(row: dict):
+    iid = int(row["id"])
+    with st.expander("🗑️ Excluir permanentemente"):
+        conf = st.text_input("Digite CONFIRMAR para excluir", max_chars=len("CONFIRMAR"), key=f"del_{iid}")
+        if st.button("Excluir RNC", key=f"delok_{iid}"):
+            if conf == "CONFIRMAR":
+                remove_photos(delete_inspecao(iid))
+                acao_feita("RNC excluída.")
+            else:
+                st.warning("Digite CONFIRMAR exatamente.")
+
+@st.fragment
+def page_consultar():
     st.title("Consultar / Editar RNCs")
-    df = pd.read_sql("SELECT id, data, rnc_num, titulo, emitente, area, pep, categoria, severidade, status FROM inspecoes ORDER BY id DESC", engine)
-    st.dataframe(df, use_container_width=True, height=320)
+    msg = st.session_state.pop("consulta_msg", None)
+    if msg:
+        st.success(msg)
+    f1, f2, f3, f4 = st.columns(4)
+    f_status = f1.multiselect("Status", STATUS_OPTS)
+    f_sev = f2.multiselect("Severidade", SEV_OPTS)
+    f_area = f3.text_input("Área contém")
+    f_pep = f4.text_input("PEP contém")
+    filtros = (tuple(f_status), tuple(f_sev), f_area.strip(), f_pep.strip())
+    if st.session_state.get("consulta_filtros") != filtros:
+        # Filtro novo: volta para a primeira página
+        st.session_state.consulta_filtros = filtros
+        st.session_state.consulta_cursores = [None]
+    cursores = st.session_state.consulta_cursores
+    df = load_inspecoes_page(cursores[-1], filtros)
+    st.dataframe(df, use_container_width=True, height=320,
+                 column_config={"data": st.column_config.DatetimeColumn("data", format="DD/MM/YYYY HH:mm")})
+    total = count_inspecoes(filtros)
+    paginas = max(1, -(-total // PAGE_SIZE))
+    cp, ci, cn = st.columns([1, 2, 1])
+    cp.button("◀ Anterior", disabled=len(cursores) == 1, on_click=cursores.pop)
+    ci.caption(f"Página {len(cursores)} de {paginas} · {total} RNC(s)")
+    cn.button("Próxima ▶", disabled=len(df) < PAGE_SIZE or len(cursores) >= paginas, on_click=cursores.append,
+              args=(int(df["id"].iloc[-1]) if len(df) else None,))
     if df.empty:
         st.info("Sem registros.")
     else:
         sel = st.number_input("Ver RNC (ID)", min_value=int(df["id"].min()), max_value=int(df["id"].max()), value=int(df["id"].iloc[0]), step=1)
-        with engine.begin() as conn:
-            row = conn.exec_driver_sql("SELECT * FROM inspecoes WHERE id=:i", {"i": int(sel)}).mappings().first()
-            fotosA = conn.exec_driver_sql("SELECT * FROM fotos WHERE inspecao_id=:i AND tipo='abertura'", {"i": int(sel)}).mappings().all()
-            fotosE = conn.exec_driver_sql("SELECT * FROM fotos WHERE inspecao_id=:i AND tipo='encerramento'", {"i": int(sel)}).mappings().all()
-            fotosR = conn.exec_driver_sql("SELECT * FROM fotos WHERE inspecao_id=:i AND tipo='reabertura'", {"i": int(sel)}).mappings().all()
+        row = fetch_row(sel)
 
         if not row:
             st.error("ID não encontrado.")
         else:
-            st.subheader(f"RNC {row['rnc_num']} — {row['status']}")
-            st.write(f"**Título:** {row['titulo']}")
-            st.write(f"**Descrição:** {row['descricao']}")
-            st.write(f"**Referências:** {row['referencias']}")
-
-            cols = st.columns(4)
-            for i, fo in enumerate(fotosA[:8]):
-                with cols[i % 4]:
-                    st.image(fo["url"] or fo["path"], use_column_width=True, caption="Abertura")
-            for i, fo in enumerate(fotosE[:8]):
-                with cols[i % 4]:
-                    st.image(fo["url"] or fo["path"], use_column_width=True, caption="Encerramento")
-            for i, fo in enumerate(fotosR[:8]):
-                with cols[i % 4]:
-                    st.image(fo["url"] or fo["path"], use_column_width=True, caption="Reabertura")
+            # Textos de exibição montados uma vez por registro (NULL aparece vazio, não "None")
+            det = {k: ("" if v is None else str(v)) for k, v in row.items()}
+            st.subheader(f"RNC {det['rnc_num']} — {det['status']}")
+            st.write(f"**Área/Local:** {det['area']}")
+            st.write(f"**Título:** {det['titulo']}")
+            st.write(f"**Descrição:** {det['descricao']}")
+            st.write(f"**Referências:** {det['referencias']}")
+
+            # Fotos só sob demanda: sem o toggle, nem consulta nem download das imagens
+            if st.toggle("📷 Mostrar fotos", key=f"fotos_{row['id']}"):
+                fotos = fetch_photos(int(sel))
+                cols = st.columns(4)
+                for i, fo in enumerate(fotos["abertura"][:8]):
+                    with cols[i % 4]:
+                        st.image(fo["url"] or fo["path"], use_column_width=True, caption="Abertura")
+                for i, fo in enumerate(fotos["encerramento"][:8]):
+                    with cols[i % 4]:
+                        st.image(fo["url"] or fo["path"], use_column_width=True, caption="Encerramento")
+                for i, fo in enumerate(fotos["reabertura"][:8]):
+                    with cols[i % 4]:
+                        st.image(fo["url"] or fo["path"], use_column_width=True, caption="Reabertura")
+                if not any(fotos.values()):
+                    st.caption("Sem fotos.")
 
             st.markdown("---")
             if st.session_state.get("is_quality"):
-                with st.expander("✅ Encerrar RNC"):
-                    encerr_por = st.text_input("Encerrada por", key=f"encpor_{row['id']}")
-                    encerr_obs = st.text_area("Observações", key=f"encobs_{row['id']}")
-                    encerr_desc = st.text_area("Descrição do fechamento", key=f"encdesc_{row['id']}")
-                    eficacia = st.selectbox("Eficácia", ["A verificar","Eficaz","Não eficaz"], key=f"ef_{row['id']}")
-                    fotos_enc = st.file_uploader("Evidências (fotos)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"encf_{row['id']}")
-                    if st.button("Encerrar agora", key=f"encok_{row['id']}"):
-                        metas = upload_photos(fotos_enc or [], row["rnc_num"], "encerramento")
-                        with engine.begin() as conn:
-                            conn.exec_driver_sql("""
-                                UPDATE inspecoes SET status='Encerrada', encerrada_em=:dt, encerrada_por=:por,
-                                    encerramento_obs=:obs, encerramento_desc=:desc, eficacia=:ef WHERE id=:i
-                            """, {"dt": datetime.now(), "por": encerr_por, "obs": encerr_obs, "desc": encerr_desc, "ef": eficacia, "i": int(sel)})
-                            for m in metas:
-                                conn.exec_driver_sql("""
-                                    INSERT INTO fotos (inspecao_id, tipo, url, path, filename, mimetype)
-                                    VALUES (:i,:t,:u,:p,:n,:m)
-                                """, {"i": int(sel), "t": m["tipo"], "u": m["url"], "p": m["path"], "n": m["filename"], "m": m["mimetype"]})
-                        st.success("RNC encerrada.")
-
-                with st.expander("♻️ Reabrir RNC"):
-                    reab_por = st.text_input("Reaberta por", key=f"repor_{row['id']}")
-                    reab_motivo = st.text_input("Motivo", key=f"remot_{row['id']}")
-                    reab_desc = st.text_area("Descrição da reabertura", key=f"redesc_{row['id']}")
-                    fotos_rea = st.file_uploader("Fotos (opcional)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"ref_{row['id']}")
-                    if st.button("Reabrir agora", key=f"reok_{row['id']}"):
-                        metas = upload_photos(fotos_rea or [], row["rnc_num"], "reabertura")
-                        with engine.begin() as conn:
-                            conn.exec_driver_sql("""
-                                UPDATE inspecoes SET status='Em ação', reaberta_em=:dt, reaberta_por=:por,
-                                    reabertura_motivo=:mot, reabertura_desc=:desc WHERE id=:i
-                            """, {"dt": datetime.now(), "por": reab_por, "mot": reab_motivo, "desc": reab_desc, "i": int(sel)})
-                            for m in metas:
-                                conn.exec_driver_sql("""
-                                    INSERT INTO fotos (inspecao_id, tipo, url, path, filename, mimetype)
-                                    VALUES (:i,:t,:u,:p,:n,:m)
-                                """, {"i": int(sel), "t": m["tipo"], "u": m["url"], "p": m["path"], "n": m["filename"], "m": m["mimetype"]})
-                        st.success("RNC reaberta.")
-
-                with st.expander("🚫 Cancelar RNC"):
-                    c_por = st.text_input("Cancelada por", key=f"canpor_{row['id']}")
-                    c_mot = st.text_area("Motivo", key=f"canmot_{row['id']}")
-                    if st.button("Cancelar", key=f"canok_{row['id']}"):
-                        with engine.begin() as conn:
-                            conn.exec_driver_sql("""
-                                UPDATE inspecoes SET status='Cancelada', cancelada_em=:dt, cancelada_por=:por, cancelamento_motivo=:mot WHERE id=:i
-                            """, {"dt": datetime.now(), "por": c_por, "mot": c_mot, "i": int(sel)})
-                        st.success("RNC cancelada.")
-
-                with st.expander("🗑️ Excluir permanentemente"):
-                    conf = st.text_input("Digite CONFIRMAR para excluir", key=f"del_{row['id']}")
-                    if st.button("Excluir RNC", key=f"delok_{row['id']}"):
-                        if conf.strip().upper() == "CONFIRMAR":
-                            with engine.begin() as conn:
-                                conn.exec_driver_sql("DELETE FROM fotos WHERE inspecao_id=:i", {"i": int(sel)})
-                                conn.exec_driver_sql("DELETE FROM inspecoes WHERE id=:i", {"i": int(sel)})
-                            st.success("RNC excluída.")
-                        else:
-                            st.warning("Digite CONFIRMAR exatamente.")
+                acao_encerrar(row)
+                acao_reabrir(row)
+                acao_cancelar(row)
+                acao_excluir(row)
             else:
                 st.info("Entre como Qualidade para encerrar/reabrir/cancelar/excluir.")
 
 # 🏷️ PEPs
-elif menu == "🏷️ PEPs":
+@st.fragment
+def page_peps():
     st.title("Gerenciar PEPs")
-    dfp = pd.read_sql("SELECT id, code FROM peps ORDER BY code", engine)
+    dfp = load_peps()
     st.dataframe(dfp, use_container_width=True, height=300)
 
     st.subheader("Importar PEPs por CSV")
     up_pep = st.file_uploader("CSV com coluna 'code' (ou 1 PEP por linha sem cabeçalho).", type=["csv"], key="up_pep")
     if up_pep and st.button("Importar PEPs do CSV"):
         try:
-            dfp_in = pd.read_csv(up_pep)
-            if 'code' in dfp_in.columns:
-                lst = [str(x) for x in dfp_in['code'].fillna('') if str(x).strip()]
-            else:
-                up_pep.seek(0)
-                import io as _io, csv as _csv
-                reader = _csv.reader(_io.StringIO(up_pep.getvalue().decode('utf-8')))
-                lst = [row[0] for row in reader if row and str(row[0]).strip()]
+            dfp_in = read_csv_fast(up_pep, text_cols=("code",))
         except Exception:
-            up_pep.seek(0)
-            import io as _io, csv as _csv
-            reader = _csv.reader(_io.StringIO(up_pep.getvalue().decode('utf-8')))
+            dfp_in = None
+        if dfp_in is not None and 'code' in dfp_in.columns:
+            codes = dfp_in['code'].dropna().astype("string").str.strip()
+            lst = codes[codes != ""].drop_duplicates().tolist()
+        else:
+            reader = csv.reader(io.StringIO(up_pep.getvalue().decode('utf-8')))
             lst = [row[0] for row in reader if row and str(row[0]).strip()]
         n = add_peps_bulk(lst)
         st.success(f"{n} PEP(s) adicionados.")
@@ -585,98 +987,116 @@ elif menu == "🏷️ PEPs":
         st.success(f"{n} adicionado(s).")
 
 # ⬇️⬆️ CSV
-elif menu == "⬇️⬆️ CSV":
+@st.fragment
+def page_csv():
     st.title("Importar / Exportar CSV de RNCs")
-    df_all = pd.read_sql("SELECT * FROM inspecoes ORDER BY id DESC", engine)
-    st.download_button("⬇️ Exportar CSV", data=df_all.to_csv(index=False).encode("utf-8-sig"), file_name="rnc_export_v08.csv", mime="text/csv")
+    # O CSV só é gerado quando o botão é clicado
+    st.download_button("⬇️ Exportar CSV", data=export_csv_bytes, file_name="rnc_export_v08.csv", mime="text/csv")
 
     st.subheader("Importar CSV de RNCs")
     up = st.file_uploader("Selecione um CSV com colunas compatíveis (não inclua 'id').", type=["csv"])
 
-    def norm_dt(val):
-        if pd.isna(val) or str(val).strip() == "":
-            return None
-        try:
-            return pd.to_datetime(val, errors="coerce")
-        except Exception:
-            return None
+    IMPORT_RENAME = {
+        "rnc_num": "rnc", "emitente": "emit", "titulo": "tit", "descricao": "desc", "referencias": "refs",
+        "causador": "cau", "processo_envolvido": "proc", "origem": "ori", "severidade": "sev", "categoria": "cat",
+    }
+    IMPORT_KEYS = ["data", "rnc", "emit", "area", "pep", "tit", "desc", "refs", "cau", "proc", "ori", "sev", "cat"]
+    # Colunas de texto já tipadas na leitura: sem inferência de tipo (e "2025-001"/PEPs numéricos não viram número)
+    IMPORT_TEXT_COLS = (
+        "rnc_num", "emitente", "area", "pep", "titulo", "responsavel", "descricao", "referencias",
+        "causador", "processo_envolvido", "origem", "severidade", "categoria", "acoes", "status",
+    )
+
+    def to_records(df):
+        # "data" já vem parseada de import_chunk; vira datetime nativo de uma vez (o sqlite3 não aceita Timestamp)
+        out = df.astype(object).where(df.notna(), None)
+        d = df["data"]
+        out["data"] = pd.Series(list(d.dt.to_pydatetime()), index=df.index, dtype=object).where(d.notna(), None)
+        return out.to_dict(orient="records")
+
+    def import_chunk(conn, imp2):
+        # Só as colunas de IMPORT_KEYS seguem; "data" é a única data entre elas e é parseada uma vez
+        imp2 = imp2.rename(columns=IMPORT_RENAME).reindex(columns=IMPORT_KEYS)
+        imp2["data"] = parse_dates(imp2["data"])
+        imp2["rnc"] = imp2["rnc"].astype("string").str.strip().fillna("")
+
+        # Números do CSV são respeitados quando ainda não existem no banco (nem repetem no arquivo;
+        # os de blocos anteriores já estão no banco, dentro desta mesma transação)
+        taken = existing_rnc_nums(conn, set(imp2.loc[imp2["rnc"] != "", "rnc"]))
+        keep = (imp2["rnc"] != "") & ~imp2["rnc"].isin(taken) & ~imp2["rnc"].duplicated()
+        # Demais linhas: uma única reserva de faixa no contador. Uma só carga em lote, na ordem
+        # do arquivo: os ids seguem as linhas, como antes
+        recs = to_records(imp2)
+        auto = [i for i, k in enumerate(keep.tolist()) if not k]
+        if auto:
+            nums = alloc_rnc_nums_tx(conn, len(auto), frozenset(imp2.loc[keep, "rnc"]))
+            for i, num in zip(auto, nums):
+                recs[i]["rnc"] = num
+        insert_inspecoes_bulk(conn, recs)
+        return len(recs) - len(auto), len(auto)
+
+    IMPORT_ALLOWED = [
+        "data","rnc_num","emitente","area","pep","titulo","responsavel","descricao","referencias",
+        "causador","processo_envolvido","origem","severidade","categoria","acoes","status",
+        "encerrada_em","encerrada_por","encerramento_obs","encerramento_desc","eficacia",
+        "responsavel_acao","reaberta_em","reaberta_por","reabertura_motivo","reabertura_desc",
+        "cancelada_em","cancelada_por","cancelamento_motivo"
+    ]
 
     if up and st.button("Importar agora"):
-        try:
-            imp = pd.read_csv(up)
-        except Exception:
-            up.seek(0)
-            imp = pd.read_csv(up, sep=";")
-
-        if 'id' in imp.columns:
-            imp = imp.drop(columns=['id'])
-
-        allowed = [
-            "data","rnc_num","emitente","area","pep","titulo","responsavel","descricao","referencias",
-            "causador","processo_envolvido","origem","severidade","categoria","acoes","status",
-            "encerrada_em","encerrada_por","encerramento_obs","encerramento_desc","eficacia",
-            "responsavel_acao","reaberta_em","reaberta_por","reabertura_motivo","reabertura_desc",
-            "cancelada_em","cancelada_por","cancelamento_motivo"
-        ]
-        cols = [c for c in imp.columns if c in allowed]
-        if not cols:
+        n_hon = n_auto = 0
+        compat = True
+        falhas = []
+        linha = 2  # primeira linha de dados do arquivo (a 1 é o cabeçalho)
+        # Uma transação para o arquivo todo e um SAVEPOINT por bloco: um bloco com erro
+        # é desfeito sozinho e os demais seguem; cada bloco vira no máximo duas cargas em lote
+        with engine.begin() as conn:
+            if IS_PG:
+                # Carga em massa: o COMMIT não espera o flush do WAL. Vale só para esta transação;
+                # numa queda do servidor o pior caso é perder esta importação, sem corromper nada
+                conn.exec_driver_sql("SET LOCAL synchronous_commit TO OFF")
+            idx_defs = None
+            chunks = iter_csv_chunks(up, IMPORT_TEXT_COLS)
+            while True:
+                try:
+                    imp = next(chunks, None)
+                except Exception as e:
+                    # Erro de leitura (codificação, aspas, nº de campos) num bloco: a leitura para aí,
+                    # os blocos anteriores seguem importados
+                    falhas.append(f"Linhas {linha}–fim: leitura interrompida. {type(e).__name__}: {e}")
+                    break
+                if imp is None:
+                    break
+                cols = imp.columns.intersection(IMPORT_ALLOWED, sort=False)
+                if cols.empty:
+                    compat = False
+                    break
+                if idx_defs is None:
+                    # Só em restauração (arquivo acima de RESTORE_BYTES): importações do dia a dia
+                    # mantêm os índices e não bloqueiam quem está usando o app
+                    restore = up.getbuffer().nbytes > RESTORE_BYTES
+                    idx_defs = drop_secondary_indexes(conn) if restore else []
+                ini, linha = linha, linha + len(imp)
+                try:
+                    with conn.begin_nested():
+                        h, a = import_chunk(conn, imp[cols].copy())
+                    n_hon += h; n_auto += a
+                except Exception as e:
+                    # Só o erro do driver: a mensagem do SQLAlchemy repete o SQL e os parâmetros do bloco
+                    err = getattr(e, "orig", None) or e
+                    falhas.append(f"Linhas {ini}–{linha - 1}: {type(err).__name__}: {err}")
+            recreate_indexes(conn, idx_defs or [])
+        if not compat:
             st.error("CSV sem colunas compatíveis com 'inspecoes'.")
         else:
-            imp2 = imp[cols].copy()
-            for dc in ["data","encerrada_em","reaberta_em","cancelada_em"]:
-                if dc in imp2.columns:
-                    imp2[dc] = imp2[dc].apply(norm_dt)
-
-            inserted, auto_num, honored = 0, 0, 0
-            with engine.begin() as conn:
-                for _, r in imp2.fillna("").iterrows():
-                    payload = {
-                        "data": r.get("data") if "data" in cols else None,
-                        "emit": r.get("emitente") if "emitente" in cols else None,
-                        "area": r.get("area") if "area" in cols else None,
-                        "pep": r.get("pep") if "pep" in cols else None,
-                        "tit": r.get("titulo") if "titulo" in cols else None,
-                        "desc": r.get("descricao") if "descricao" in cols else None,
-                        "refs": r.get("referencias") if "referencias" in cols else None,
-                        "cau": r.get("causador") if "causador" in cols else None,
-                        "proc": r.get("processo_envolvido") if "processo_envolvido" in cols else None,
-                        "ori": r.get("origem") if "origem" in cols else None,
-                        "sev": r.get("severidade") if "severidade" in cols else None,
-                        "cat": r.get("categoria") if "categoria" in cols else None,
-                    }
-                    csv_num = str(r.get("rnc_num")).strip() if "rnc_num" in cols else ""
-                    rid = None
-                    if csv_num:
-                        try:
-                            if DB_KIND == "postgresql":
-                                rid = conn.exec_driver_sql("""
-                                    INSERT INTO inspecoes
-                                    (data, rnc_num, emitente, area, pep, titulo, responsavel, descricao, referencias, causador,
-                                     processo_envolvido, origem, severidade, categoria, acoes, status)
-                                    VALUES (:data, :rnc, :emit, :area, :pep, :tit, '', :desc, :refs, :cau, :proc, :ori, :sev, :cat, '', 'Aberta')
-                                    ON CONFLICT (rnc_num) DO NOTHING
-                                    RETURNING id;
-                                """, dict(payload, rnc=csv_num)).scalar()
-                                if rid is not None: honored += 1
-                            else:
-                                conn.exec_driver_sql("""
-                                    INSERT OR IGNORE INTO inspecoes
-                                    (data, rnc_num, emitente, area, pep, titulo, responsavel, descricao, referencias, causador,
-                                     processo_envolvido, origem, severidade, categoria, acoes, status)
-                                    VALUES (:data, :rnc, :emit, :area, :pep, :tit, '', :desc, :refs, :cau, :proc, :ori, :sev, :cat, '', 'Aberta');
-                                """, dict(payload, rnc=csv_num))
-                                lrid = conn.exec_driver_sql("SELECT last_insert_rowid()").scalar()
-                                if lrid and int(lrid) > 0: honored += 1; rid = int(lrid)
-                        except Exception:
-                            rid = None
-                    if not rid:
-                        rid, gen = insert_rnc_with_counter(conn, payload)
-                        auto_num += 1
-                    inserted += 1
-            st.success(f"Importação concluída. Inseridos: {inserted}. Respeitados do CSV: {honored}. Gerados automaticamente: {auto_num}.")
+            invalidate_inspecoes()
+            st.success(f"Importação concluída. Inseridos: {n_hon + n_auto}. Respeitados do CSV: {n_hon}. Gerados automaticamente: {n_auto}.")
+            if falhas:
+                st.warning("Blocos não importados (nenhuma linha deles foi gravada):\n\n" + "\n\n".join(falhas))
 
 # ℹ️ Status
-elif menu == "ℹ️ Status":
+@st.fragment
+def page_status():
     st.title("Status do App")
     st.write(f"**Build:** {BUILD_TAG}")
     st.write(f"**DB:** {DB_KIND}")
@@ -688,3 +1108,15 @@ elif menu == "ℹ️ Status":
         st.success(f"Ping DB OK — {v}")
     except Exception as e:
         st.error(f"Falha no ping: {e}")
+
+PAGES = {
+    "➕ Nova RNC": page_nova,
+    "🔎 Consultar/Editar": page_consultar,
+    "🏷️ PEPs": page_peps,
+    "⬇️⬆️ CSV": page_csv,
+    "ℹ️ Status": page_status,
+}
+
+auth_box()
+menu = st.sidebar.radio("Menu", list(PAGES))
+PAGES[menu]()